@@ -1,13 +1,21 @@
+import functools
 import json
+import os
 import re
 import string
 from urllib.parse import urlparse
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from bs4.element import Tag
 
-TG_CORE_TYPES = ["String", "Boolean", "Integer", "Float"]
+try:
+    # Optional; much faster at writing out the (large) schema files.
+    import orjson
+except ImportError:
+    orjson = None
+
+TG_CORE_TYPES = frozenset({"String", "Boolean", "Integer", "Float"})
 
 ROOT_URL = ""
 TO_SCRAPE = {
@@ -16,6 +24,9 @@ TO_SCRAPE = {
     "botapicorefork": "https" + "://" + "corefork.telegram.org" + "/bots/api",
 }
 
+# Last fetched copy of each docs page, keyed by its ETag, to avoid re-downloading unchanged pages.
+CACHE_DIR = ".cache"
+
 METHODS = "methods"
 TYPES = "types"
 
@@ -28,10 +39,80 @@ APPROVED_MULTI_RETURNS = [
     ['Message', 'Boolean']  # Edit returns either the new message, or an OK to confirm the edit.
 ]
 
+# Type names used in the docs which should be mapped to their proper type.
+TYPE_ALIASES = {
+    "Messages": "Message",  # Avoids https://core.telegram.org/bots/api#sendmediagroup
+    "Float number": "Float",
+    "Int": "Integer",
+    "True": "Boolean",
+    "Bool": "Boolean",
+}
 
-def retrieve_info(url: str) -> dict:
-    r = requests.get(url)
-    soup = BeautifulSoup(r.text, features="html5lib")
+# Patterns used to find the return type in a method description.
+RETURN_ON_SUCCESS_RE = re.compile("(?:on success,)([^.]*)", re.IGNORECASE)
+RETURNS_RE = re.compile("(?:returns)([^.]*)(?:on success)?", re.IGNORECASE)
+IS_RETURNED_RE = re.compile("([^.]*)(?:is returned)", re.IGNORECASE)
+# In order of preference; a description can match several of them.
+RETURN_TYPE_PATTERNS = (RETURN_ON_SUCCESS_RE, RETURNS_RE, IS_RETURNED_RE)
+ARRAY_OF_RE = re.compile(r"(?:array of )+(\w*)", re.IGNORECASE)
+# Strips all punctuation from a string when passed to str.translate.
+STRIP_PUNCTUATION = str.maketrans("", "", string.punctuation)
+# Unicode characters in descriptions which should be replaced with plain ASCII.
+DESCRIPTION_CHARS = str.maketrans({
+    # Replace weird UTF-8 quotes with proper quotes
+    "”": '"',
+    "“": '"',
+    # Replace weird unicode ellipsis with three dots
+    "…": "...",
+    # Use sensible dashes
+    u"\u2013": "-",
+    u"\u2014": "-",
+    # Use sensible single quotes
+    u"\u2019": "'",
+})
+# Runs of whitespace (eg double space, newlines, tabs) in descriptions.
+MULTI_WHITESPACE_RE = re.compile(r"(\s){2,}")
+
+
+def fetch_page(url: str, cache_name: str) -> tuple[bytes, str]:
+    etag_path = os.path.join(CACHE_DIR, cache_name + ".etag")
+    body_path = os.path.join(CACHE_DIR, cache_name + ".html")
+    encoding_path = os.path.join(CACHE_DIR, cache_name + ".encoding")
+
+    headers = {}
+    # Only make the request conditional if we still have the cached body to fall back on.
+    if os.path.exists(etag_path) and os.path.exists(body_path) and os.path.exists(encoding_path):
+        with open(etag_path) as f:
+            headers["If-None-Match"] = f.read().strip()
+
+    r = requests.get(url, headers=headers)
+    if r.status_code == 304:
+        # Decode the cached body the same way as when it was first fetched.
+        with open(encoding_path) as f:
+            encoding = f.read().strip()
+        with open(body_path, "rb") as f:
+            return f.read(), encoding
+
+    encoding = r.encoding or "utf-8"
+    etag = r.headers.get("ETag")
+    if r.status_code == 200 and etag:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(body_path, "wb") as f:
+            f.write(r.content)
+        with open(encoding_path, "w") as f:
+            f.write(encoding)
+        with open(etag_path, "w") as f:
+            f.write(etag)
+
+    return r.content, encoding
+
+
+def retrieve_info(url: str, cache_name: str) -> dict:
+    content, encoding = fetch_page(url, cache_name)
+    # Only build the tree for the docs body; everything else on the page is discarded anyway.
+    dev_content = SoupStrainer("div", id="dev_page_content")
+    # requests already knows the charset from the response headers, so don't make bs4 guess it.
+    soup = BeautifulSoup(content, features="lxml", parse_only=dev_content, from_encoding=encoding)
     dev_rules = soup.find("div", {"id": "dev_page_content"})
     curr_type = ""
     curr_name = ""
@@ -50,7 +131,7 @@ def retrieve_info(url: str) -> dict:
         TYPES: dict(),
     }
 
-    for x in list(dev_rules.children):  # type: Tag
+    for x in dev_rules.children:  # type: Tag
         if x.name == "h3" or x.name == "hr":
             # New category; clear name and type.
             curr_name = ""
@@ -69,24 +150,27 @@ def retrieve_info(url: str) -> dict:
         if not curr_type or not curr_name:
             continue
 
+        entry = items[curr_type][curr_name]
+
         if x.name == "p":
-            items[curr_type][curr_name].setdefault("description", []).extend(clean_tg_description(x, url))
+            paragraph = clean_tg_description(x, url)
+            entry.setdefault("description", []).extend(paragraph)
+
+            # Only methods have return types.
+            # Look for them in each new paragraph, until we have found one.
+            if curr_type == METHODS and paragraph and not entry.get("returns"):
+                get_method_return_type(curr_name, paragraph, entry)
 
         if x.name == "table":
-            get_fields(curr_name, curr_type, x, items, url)
+            get_fields(curr_name, curr_type, x, entry, url)
 
         if x.name == "ul":
-            get_subtypes(curr_name, curr_type, x, items, url)
-
-        # Only methods have return types.
-        # We check this every time just in case the description has been updated, and we have new return types to add.
-        if curr_type == METHODS and items[curr_type][curr_name].get("description"):
-            get_method_return_type(curr_name, curr_type, items[curr_type][curr_name].get("description"), items)
+            get_subtypes(curr_name, curr_type, x, entry, url)
 
     return items
 
 
-def get_subtypes(curr_name: str, curr_type: str, x: Tag, items: dict, url: str):
+def get_subtypes(curr_name: str, curr_type: str, x: Tag, entry: dict, url: str):
     if curr_name == "InputFile":  # Has no interesting subtypes
         return
 
@@ -96,24 +180,27 @@ def get_subtypes(curr_name: str, curr_type: str, x: Tag, items: dict, url: str):
 
     # List items found in types define possible subtypes.
     if curr_type == TYPES:
-        items[curr_type][curr_name]["subtypes"] = list_contents
+        entry["subtypes"] = list_contents
 
     # Always add the list to the description, for better docs.
-    items[curr_type][curr_name]["description"] += [f"- {s}" for s in list_contents]
+    entry["description"] += [f"- {s}" for s in list_contents]
 
 
 # Get fields/parameters of type/method
-def get_fields(curr_name: str, curr_type: str, x: Tag, items: dict, url: str):
-    body = x.find("tbody")
+def get_fields(curr_name: str, curr_type: str, x: Tag, entry: dict, url: str):
+    body = x.find("tbody", recursive=False)
     fields = []
-    for tr in body.find_all("tr"):
-        children = list(tr.find_all("td"))
+    for tr in get_child_tags(body, "tr"):
+        # Cells are direct children of the row; no need to search through their contents.
+        children = get_child_tags(tr, "td")
+        # The last cell is the description, which gets cleaned up separately.
+        texts = [c.get_text() for c in children[:-1]]
         if curr_type == TYPES and len(children) == 3:
             desc = clean_tg_field_description(children[2], url)
             fields.append(
                 {
-                    "name": children[0].get_text(),
-                    "types": clean_tg_type(children[1].get_text()),
+                    "name": texts[0],
+                    "types": list(clean_tg_type(texts[1])),
                     "required": not desc.startswith("Optional. "),
                     "description": desc,
                 }
@@ -122,37 +209,34 @@ def get_fields(curr_name: str, curr_type: str, x: Tag, items: dict, url: str):
         elif curr_type == METHODS and len(children) == 4:
             fields.append(
                 {
-                    "name": children[0].get_text(),
-                    "types": clean_tg_type(children[1].get_text()),
-                    "required": children[2].get_text() == "Yes",
+                    "name": texts[0],
+                    "types": list(clean_tg_type(texts[1])),
+                    "required": texts[2] == "Yes",
                     "description": clean_tg_field_description(children[3], url)
                 }
             )
 
         else:
-            print("An unexpected state has occurred!")
-            print("Type:", curr_type)
-            print("Name:", curr_name)
-            print("Number of children:", len(children))
-            print(children)
-            exit(1)
+            raise ValueError(f"Unexpected row in {curr_type}/{curr_name}: {len(children)} cells")
 
-    items[curr_type][curr_name]["fields"] = fields
+    entry["fields"] = fields
 
 
-def get_method_return_type(curr_name: str, curr_type: str, description_items: list[str], items: dict):
+# Cheaper than find_all(name, recursive=False), which goes through bs4's generic matching for every child.
+def get_child_tags(t: Tag, name: str) -> list[Tag]:
+    return [c for c in t.children if c.name == name]
+
+
+def get_method_return_type(curr_name: str, description_items: list[str], entry: dict):
     description = "\n".join(description_items)
-    ret_search = re.search("(?:on success,)([^.]*)", description, re.IGNORECASE)
-    ret_search2 = re.search("(?:returns)([^.]*)(?:on success)?", description, re.IGNORECASE)
-    ret_search3 = re.search("([^.]*)(?:is returned)", description, re.IGNORECASE)
-    if ret_search:
-        extract_return_type(curr_type, curr_name, ret_search.group(1).strip(), items)
-    elif ret_search2:
-        extract_return_type(curr_type, curr_name, ret_search2.group(1).strip(), items)
-    elif ret_search3:
-        extract_return_type(curr_type, curr_name, ret_search3.group(1).strip(), items)
-    else:
-        print("WARN - failed to get return type for", curr_name)
+    # Only run the next pattern if the previous ones didn't match.
+    for pattern in RETURN_TYPE_PATTERNS:
+        ret_search = pattern.search(description)
+        if ret_search:
+            extract_return_type(ret_search.group(1).strip(), entry)
+            return
+
+    print("WARN - failed to get return type for", curr_name)
 
 def get_type_and_name(t: Tag, anchor: Tag, items: dict, url: str):
     if t.text[0].isupper():
@@ -160,29 +244,29 @@ def get_type_and_name(t: Tag, anchor: Tag, items: dict, url: str):
     else:
         curr_type = METHODS
     curr_name = t.get_text()
-    items[curr_type][curr_name] = {"name": curr_name}
+    entry = items[curr_type][curr_name] = {"name": curr_name}
 
     href = anchor.get("href")
     if href:
-        items[curr_type][curr_name]["href"] = url + href
+        entry["href"] = url + href
 
     return curr_name, curr_type
 
 
-def extract_return_type(curr_type: str, curr_name: str, ret_str: str, items: dict):
-    array_match = re.search(r"(?:array of )+(\w*)", ret_str, re.IGNORECASE)
+def extract_return_type(ret_str: str, entry: dict):
+    array_match = ARRAY_OF_RE.search(ret_str)
     if array_match:
         ret = clean_tg_type(array_match.group(1))
         rets = [f"Array of {r}" for r in ret]
-        items[curr_type][curr_name]["returns"] = rets
+        entry["returns"] = rets
     else:
         words = ret_str.split()
         rets = [
             r for ret in words
-            for r in clean_tg_type(ret.translate(str.maketrans("", "", string.punctuation)))
+            for r in clean_tg_type(ret.translate(STRIP_PUNCTUATION))
             if ret[0].isupper()
         ]
-        items[curr_type][curr_name]["returns"] = rets
+        entry["returns"] = rets
 
 
 def clean_tg_field_description(t: Tag, url: str) -> str:
@@ -190,69 +274,52 @@ def clean_tg_field_description(t: Tag, url: str) -> str:
 
 
 def clean_tg_description(t: Tag, url: str) -> list[str]:
-    # Replace HTML emoji images with actual emoji
-    for i in t.find_all("img"):
-        i.replace_with(i.get("alt"))
-
-    # Make sure to include linebreaks, or spacing gets weird
-    for br in t.find_all("br"):
-        br.replace_with("\n")
-
-    # Replace helpful anchors with the actual URL.
-    for a in t.find_all("a"):
-        anchor_text = a.get_text()
-        if "»" not in anchor_text:
-            continue
+    # Walk the tree once, innermost tags first, so that anchors see their already-rewritten children.
+    for el in reversed(list(t.descendants)):
+        # Replace HTML emoji images with actual emoji
+        if el.name == "img":
+            el.replace_with(el.get("alt"))
+
+        # Make sure to include linebreaks, or spacing gets weird
+        elif el.name == "br":
+            el.replace_with("\n")
+
+        # Replace helpful anchors with the actual URL.
+        elif el.name == "a":
+            anchor_text = el.get_text()
+            if "»" not in anchor_text:
+                continue
 
-        link = a.get("href")
-        # Page-relative URL
-        if link.startswith("#"):
-            link = url + link
-        # Domain-relative URL
-        elif link.startswith("/"):
-            link = ROOT_URL + link
+            link = el.get("href")
+            # Page-relative URL
+            if link.startswith("#"):
+                link = url + link
+            # Domain-relative URL
+            elif link.startswith("/"):
+                link = ROOT_URL + link
 
-        anchor_text = anchor_text.replace(" »", ": " + link)
-        a.replace_with(anchor_text)
+            anchor_text = anchor_text.replace(" »", ": " + link)
+            el.replace_with(anchor_text)
 
     text = t.get_text()
 
     # Replace any weird double whitespaces (eg double space, newlines, tabs) with single occurrences
-    text = re.sub(r"(\s){2,}", r"\1", text)
-
-    # Replace weird UTF-8 quotes with proper quotes
-    text = text.replace('”', '"').replace('“', '"')
-
-    # Replace weird unicode ellipsis with three dots
-    text = text.replace("…", "...")
+    text = MULTI_WHITESPACE_RE.sub(r"\1", text)
 
-    # Use sensible dashes
-    text = text.replace(u"\u2013", "-")
-    text = text.replace(u"\u2014", "-")
-    # Use sensible single quotes
-    text = text.replace(u"\u2019", "'")
+    text = text.translate(DESCRIPTION_CHARS)
 
     # Split on newlines to improve description output.
-    return [t.strip() for t in text.split("\n") if t.strip()]
+    return [line for line in map(str.strip, text.split("\n")) if line]
 
 
 def get_proper_type(t: str) -> str:
-    if t == "Messages":  # Avoids https://core.telegram.org/bots/api#sendmediagroup
-        return "Message"
-
-    elif t == "Float number":
-        return "Float"
+    return TYPE_ALIASES.get(t, t)
 
-    elif t == "Int":
-        return "Integer"
-
-    elif t == "True" or t == "Bool":
-        return "Boolean"
-
-    return t
 
-
-def clean_tg_type(t: str) -> list[str]:
+# Type strings repeat a lot across the docs, so cache the results. A tuple is returned so the cached value can't be
+# mutated by callers.
+@functools.lru_cache(maxsize=None)
+def clean_tg_type(t: str) -> tuple[str, ...]:
     pref = ""
     if t.startswith("Array of "):
         pref = "Array of "
@@ -261,12 +328,20 @@ def clean_tg_type(t: str) -> list[str]:
     fixed_ors = [x.strip() for x in t.split(" or ")]  # Fix situations like "A or B"
     fixed_ands = [x.strip() for fo in fixed_ors for x in fo.split(" and ")]  # Fix situations like "A and B"
     fixed_commas = [x.strip() for fa in fixed_ands for x in fa.split(", ")]  # Fix situations like "A, B"
-    return [pref + get_proper_type(x) for x in fixed_commas]
+    return tuple(pref + get_proper_type(x) for x in fixed_commas)
+
+
+# Strips any array wrapping from a type, eg "Array of Array of PhotoSize" -> "PhotoSize".
+def get_base_type(t: str) -> str:
+    while t.startswith("Array of "):
+        t = t.removeprefix("Array of ")
+    return t
 
 
 # Returns True if an issue is found.
 def verify_type_parameters(items: dict) -> bool:
     issue_found = False
+    valid_types = TG_CORE_TYPES.union(items[TYPES])
 
     for type_name, values in items[TYPES].items():
         # check all values have a URL
@@ -298,10 +373,8 @@ def verify_type_parameters(items: dict) -> bool:
         for param in fields:
             field_types = param.get("types")
             for field_type_name in field_types:
-                while field_type_name.startswith("Array of "):
-                    field_type_name = field_type_name[len("Array of "):]
-
-                if field_type_name not in items[TYPES] and field_type_name not in TG_CORE_TYPES:
+                field_type_name = get_base_type(field_type_name)
+                if field_type_name not in valid_types:
                     print("UNKNOWN FIELD TYPE", field_type_name)
                     issue_found = True
 
@@ -311,6 +384,7 @@ def verify_type_parameters(items: dict) -> bool:
 # Returns True if an issue is found.
 def verify_method_parameters(items: dict) -> bool:
     issue_found = False
+    valid_types = TG_CORE_TYPES.union(items[TYPES])
     # Type check all methods
     for method, values in items[METHODS].items():
         # check all values have a URL
@@ -335,40 +409,52 @@ def verify_method_parameters(items: dict) -> bool:
         for param in values.get("fields", []):
             types = param.get("types")
             for t in types:
-                while t.startswith("Array of "):
-                    t = t[len("Array of "):]
-
-                if t not in items[TYPES] and t not in TG_CORE_TYPES:
+                t = get_base_type(t)
+                if t not in valid_types:
                     issue_found = True
                     print("UNKNOWN PARAM TYPE", t)
 
         # check all return types are valid
         for ret in values.get("returns", []):
-            while ret.startswith("Array of "):
-                ret = ret[len("Array of "):]
-
-            if ret not in items[TYPES] and ret not in TG_CORE_TYPES:
+            ret = get_base_type(ret)
+            if ret not in valid_types:
                 issue_found = True
                 print("UNKNOWN RETURN TYPE", ret)
 
     return issue_found
 
 
+def write_json(path: str, items: dict, pretty: bool = False):
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(items, option=orjson.OPT_INDENT_2 if pretty else 0))
+        return
+
+    # Match orjson's output byte for byte, so the files don't depend on which one is installed.
+    with open(path, "w", encoding="utf-8") as f:
+        if pretty:
+            json.dump(items, f, indent=2, ensure_ascii=False)
+        else:
+            json.dump(items, f, separators=(",", ":"), ensure_ascii=False)
+
+
 def main():
     for filename, url in TO_SCRAPE.items():
         print("parsing", url)
         rupi = urlparse(url)
         ROOT_URL = rupi.scheme + "://" + rupi.netloc
-        items = retrieve_info(url)
+        try:
+            items = retrieve_info(url, filename)
+        except ValueError as e:
+            print("Failed to parse schema:", e)
+            exit(1)
+
         if verify_type_parameters(items) or verify_method_parameters(items):
             print("Failed to validate schema. View logs above for more information.")
             exit(1)
 
-        with open(f"{filename}.json", "w") as f:
-            json.dump(items, f, indent=2)
-
-        with open(f"{filename}.min.json", "w") as f:
-            json.dump(items, f)
+        write_json(f"{filename}.json", items, pretty=True)
+        write_json(f"{filename}.min.json", items)
 
 
 if __name__ == '__main__':